@@ -3,6 +3,7 @@
 One-click Startup Script - SQL-of-Thought Evaluation
 """
 
+import importlib.util
 import os
 import sys
 from pathlib import Path
@@ -46,10 +47,9 @@ def check_prerequisites():
         issues.append("Spider dataset not found")
     
     # 4. Check Python libraries
-    try:
-        from openai import OpenAI
+    if importlib.util.find_spec("openai") is not None:
         print("✓ openai library")
-    except ImportError:
+    else:
         issues.append("openai library not installed (pip install openai)")
     
     print("="*80)
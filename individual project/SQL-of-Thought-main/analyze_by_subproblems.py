@@ -7,59 +7,128 @@ import json
 import re
 from typing import List
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
-def parse_subproblems(sub_json: str) -> List[str]:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so both parsers raise the same error
+_loads = orjson.loads if orjson else json.loads
+
+
+# Common SQL clause keywords and their variants
+CLAUSE_PATTERNS = {
+    'SELECT': ['SELECT', 'SELECTING', 'COLUMNS', 'FIELDS'],
+    'FROM': ['FROM', 'TABLE', 'TABLES'],
+    'WHERE': ['WHERE', 'FILTER', 'CONDITION', 'FILTERING'],
+    'JOIN': ['JOIN', 'JOINING', 'INNER JOIN', 'LEFT JOIN', 'RIGHT JOIN', 'OUTER JOIN'],
+    'GROUP BY': ['GROUP BY', 'GROUPING', 'AGGREGATE', 'AGGREGATION'],
+    'HAVING': ['HAVING'],
+    'ORDER BY': ['ORDER BY', 'SORT', 'SORTING', 'ORDERING'],
+    'LIMIT': ['LIMIT', 'TOP', 'FIRST'],
+    'UNION': ['UNION'],
+    'INTERSECT': ['INTERSECT'],
+    'EXCEPT': ['EXCEPT', 'MINUS'],
+    'DISTINCT': ['DISTINCT', 'UNIQUE'],
+    'SUBQUERY': ['SUBQUERY', 'NESTED', 'INNER QUERY']
+}
+
+# Aho-Corasick automaton matching every pattern in a single pass over the text
+if ahocorasick:
+    AUTOMATON = ahocorasick.Automaton()
+    for _clause, _patterns in CLAUSE_PATTERNS.items():
+        for _pattern in _patterns:
+            AUTOMATON.add_word(_pattern, _clause)
+    AUTOMATON.make_automaton()
+else:
+    AUTOMATON = None
+
+# Fallback without pyahocorasick: one alternation regex, longest pattern first.
+# Matching inside a lookahead finds occurrences at every position, like `in`
+PATTERN_TO_CLAUSE = {p: c for c, ps in CLAUSE_PATTERNS.items() for p in ps}
+CLAUSE_RE = re.compile(
+    r"(?=(" + "|".join(map(re.escape, sorted(PATTERN_TO_CLAUSE, key=len, reverse=True))) + r"))"
+)
+
+
+def load_subproblem_json(sub_json: str):
     """
-    Extract SQL clause types from JSON output of subproblem agent
+    Strictly parse JSON output of subproblem agent
     
     Args:
         sub_json: JSON string containing subproblem decomposition
         
     Returns:
-        List of SQL clause types, e.g., ['SELECT', 'WHERE', 'JOIN']
+        Parsed JSON object or array, or None if sub_json is not valid JSON
     """
-    clauses = []
+    # Only JSON objects and arrays are parsed, anything else is treated as text
+    text = sub_json.lstrip()
+    if text[:1] not in ("{", "["):
+        return None
     
     try:
-        # Try to parse JSON
-        data = json.loads(sub_json)
+        return _loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def parse_subproblems(sub_json: str) -> List[str]:
+    """
+    Extract SQL clause types from JSON output of subproblem agent
+    
+    Args:
+        sub_json: JSON string containing subproblem decomposition
         
+    Returns:
+        List of SQL clause types in order of first occurrence, e.g., ['SELECT', 'WHERE', 'JOIN']
+    """
+    data = load_subproblem_json(sub_json)
+    if data is None:
+        # If JSON parsing fails, extract directly from text
+        return extract_clauses_from_text(sub_json)
+    
+    if isinstance(data, dict):
         # Method 1: If JSON has "clauses" field
-        if isinstance(data, dict) and "clauses" in data:
-            clauses = data["clauses"]
+        if (clauses := data.get("clauses")) is not None:
+            return list(dict.fromkeys(clauses))
         
         # Method 2: If JSON has "subproblems" field
-        elif isinstance(data, dict) and "subproblems" in data:
-            subproblems = data["subproblems"]
-            if isinstance(subproblems, list):
-                for subprob in subproblems:
-                    if isinstance(subprob, dict) and "clause" in subprob:
-                        clauses.append(subprob["clause"])
-                    elif isinstance(subprob, str):
-                        # Extract SQL keywords from text
-                        extracted = extract_clauses_from_text(subprob)
-                        clauses.extend(extracted)
-        
-        # Method 3: If it's list format
-        elif isinstance(data, list):
-            for item in data:
-                if isinstance(item, dict) and "clause" in item:
-                    clauses.append(item["clause"])
-                elif isinstance(item, str):
-                    extracted = extract_clauses_from_text(item)
-                    clauses.extend(extracted)
+        if (subproblems := data.get("subproblems")) is not None:
+            return clauses_from_items(subproblems) if isinstance(subproblems, list) else []
         
         # Method 4: If entire JSON is text description, extract keywords from it
-        else:
-            text = json.dumps(data)
-            clauses = extract_clauses_from_text(text)
+        return extract_clauses_from_text(json.dumps(data))
     
-    except json.JSONDecodeError:
-        # If JSON parsing fails, extract directly from text
-        clauses = extract_clauses_from_text(sub_json)
+    # Method 3: If it's list format
+    return clauses_from_items(data)
+
+
+def clauses_from_items(items: list) -> List[str]:
+    """
+    Extract SQL clause types from a list of subproblems
     
-    # Deduplicate and return
-    return list(set(clauses)) if clauses else []
+    Args:
+        items: Subproblems, either dicts with a "clause" field or text descriptions
+        
+    Returns:
+        List of SQL clause types, deduplicated in order of first occurrence
+    """
+    clauses = []
+    for item in items:
+        if isinstance(item, dict):
+            if (clause := item.get("clause")) is not None:
+                clauses.append(clause)
+        elif isinstance(item, str):
+            # Extract SQL keywords from text
+            clauses.extend(extract_clauses_from_text(item))
+    
+    # Deduplicate, keeping first occurrences
+    return list(dict.fromkeys(clauses))
 
 
 def extract_clauses_from_text(text: str) -> List[str]:
@@ -72,34 +141,15 @@ def extract_clauses_from_text(text: str) -> List[str]:
     Returns:
         List of extracted SQL clauses
     """
-    clauses = []
     text_upper = text.upper()
-    
-    # Define common SQL clause keywords and their variants
-    clause_patterns = {
-        'SELECT': ['SELECT', 'SELECTING', 'COLUMNS', 'FIELDS'],
-        'FROM': ['FROM', 'TABLE', 'TABLES'],
-        'WHERE': ['WHERE', 'FILTER', 'CONDITION', 'FILTERING'],
-        'JOIN': ['JOIN', 'JOINING', 'INNER JOIN', 'LEFT JOIN', 'RIGHT JOIN', 'OUTER JOIN'],
-        'GROUP BY': ['GROUP BY', 'GROUPING', 'AGGREGATE', 'AGGREGATION'],
-        'HAVING': ['HAVING'],
-        'ORDER BY': ['ORDER BY', 'SORT', 'SORTING', 'ORDERING'],
-        'LIMIT': ['LIMIT', 'TOP', 'FIRST'],
-        'UNION': ['UNION'],
-        'INTERSECT': ['INTERSECT'],
-        'EXCEPT': ['EXCEPT', 'MINUS'],
-        'DISTINCT': ['DISTINCT', 'UNIQUE'],
-        'SUBQUERY': ['SUBQUERY', 'NESTED', 'INNER QUERY']
-    }
-    
-    # Check each clause
-    for clause, patterns in clause_patterns.items():
-        for pattern in patterns:
-            if pattern in text_upper:
-                clauses.append(clause)
-                break  # Break once found
-    
-    return clauses
+
+    if AUTOMATON is not None:
+        found = {clause for _, clause in AUTOMATON.iter(text_upper)}
+    else:
+        found = {PATTERN_TO_CLAUSE[m] for m in CLAUSE_RE.findall(text_upper)}
+
+    # Keep the order of CLAUSE_PATTERNS
+    return [clause for clause in CLAUSE_PATTERNS if clause in found]
 
 
 # Test code
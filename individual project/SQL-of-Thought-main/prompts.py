@@ -1,13 +1,11 @@
 import os
-from string import Template
 
 # API Key configuration (removed for security)
 DEEPSEEK_API_KEY = ""
 
 def alt_schema_linking_agent_prompt(question: str, table_schema: str) -> str:
     """Schema Linking Agent prompt"""
-    return Template(
-        """You are a Schema Linking Agent in an NL2SQL framework. Return the relevant schema links for generating SQL query for the question.
+    return f"""You are a Schema Linking Agent in an NL2SQL framework. Return the relevant schema links for generating SQL query for the question.
 
 Given:
 - A natural language question
@@ -19,10 +17,10 @@ Cross-check your schema for:
 - Table alias mismatches
 - Linkage errors that would lead to incorrect joins or groupBy clauses
 
-Question: $question
+Question: {question}
 
 Table Schema:
-$table_schema
+{table_schema}
 
 Return the schema links in given format:
 
@@ -30,47 +28,51 @@ Table: primary_key_col, foreign_key_col, col1, col2, ... all other columns in Ta
 
 ONLY list relevant tables and columns and Foreign Keys in given format and no other extra characters.
 """
-    ).substitute(question=question, table_schema=table_schema)
 
 
 def subproblem_agent_prompt(question: str, schema: str) -> str:
     """Subproblem Agent prompt"""
-    return Template(
-        """You are a Subproblem Agent in an NL2SQL system. Break down the question into subproblems.
+    return f"""You are a Subproblem Agent in an NL2SQL system. Break down the question into subproblems.
 
-Question: $question
+Question: {question}
 
 Schema:
-$schema
+{schema}
 
 Identify SQL clauses needed (SELECT, WHERE, JOIN, GROUP BY, HAVING, ORDER BY, LIMIT, etc.)
 
 Return JSON format:
-{
+{{
   "clauses": ["SELECT", "WHERE", "JOIN"],
   "subproblems": [
-    {"clause": "SELECT", "description": "..."},
-    {"clause": "WHERE", "description": "..."}
+    {{"clause": "SELECT", "description": "..."}},
+    {{"clause": "WHERE", "description": "..."}}
   ]
-}
+}}
 
-Return ONLY valid JSON, no extra text.
+Respond with ONLY a JSON object matching {{"clauses": [str, ...], "subproblems": [{{"clause": str, "description": str}}, ...]}}. No prose.
+"""
+
+
+def json_reformat_agent_prompt(text: str) -> str:
+    """JSON Reformat prompt, used when the Subproblem Agent output is not valid JSON"""
+    return f"""Rewrite the following as a JSON object matching {{"clauses": [str, ...], "subproblems": [{{"clause": str, "description": str}}, ...]}}. Respond with ONLY the JSON object, no prose.
+
+{text}
 """
-    ).substitute(question=question, schema=schema)
 
 
 def query_plan_agent_prompt(question: str, schema: str, subproblems: str) -> str:
     """Query Plan Agent prompt"""
-    return Template(
-        """You are a Query Plan Agent. Create a step-by-step natural language plan for SQL generation.
+    return f"""You are a Query Plan Agent. Create a step-by-step natural language plan for SQL generation.
 
-Question: $question
+Question: {question}
 
 Schema:
-$schema
+{schema}
 
 Subproblems:
-$subproblems
+{subproblems}
 
 Create a clear plan with:
 1. Which tables to use
@@ -82,21 +84,19 @@ Create a clear plan with:
 
 Return a concise bullet-pointed plan. Do NOT write SQL code.
 """
-    ).substitute(question=question, schema=schema, subproblems=subproblems)
 
 
 def sql_agent_prompt(question: str, plan: str, schema: str) -> str:
     """SQL Agent prompt"""
-    return Template(
-        """You are a SQL Generation Agent. Generate SQL query based on the plan.
+    return f"""You are a SQL Generation Agent. Generate SQL query based on the plan.
 
-Question: $question
+Question: {question}
 
 Schema:
-$schema
+{schema}
 
 Plan:
-$plan
+{plan}
 
 Generate a valid SQL query that:
 - Follows standard SQL syntax
@@ -106,53 +106,43 @@ Generate a valid SQL query that:
 
 Return ONLY the SQL query, no explanations.
 """
-    ).substitute(question=question, plan=plan, schema=schema)
 
 
 def correction_plan_agent_prompt(question: str, sql: str, schema: str, error: str) -> str:
     """Correction Plan Agent prompt"""
-    return Template(
-        """You are a SQL Correction Plan Agent. The generated SQL has an error.
+    return f"""You are a SQL Correction Plan Agent. The generated SQL has an error.
 
-Question: $question
+Question: {question}
 
 Schema:
-$schema
+{schema}
 
 Current SQL:
-$sql
+{sql}
 
 Error:
-$error
+{error}
 
 Analyze the error and create a correction plan. What needs to be fixed?
 
 Return a concise correction plan.
 """
-    ).substitute(question=question, sql=sql, schema=schema, error=str(error))
 
 
 def correction_sql_agent_prompt(question: str, schema: str, correction_plan: str, old_sql: str) -> str:
     """Correction SQL Agent prompt"""
-    return Template(
-        """You are a SQL Correction Agent. Fix the SQL based on the correction plan.
+    return f"""You are a SQL Correction Agent. Fix the SQL based on the correction plan.
 
-Question: $question
+Question: {question}
 
 Schema:
-$schema
+{schema}
 
 Old SQL (with error):
-$old_sql
+{old_sql}
 
 Correction Plan:
-$correction_plan
+{correction_plan}
 
 Generate the corrected SQL query. Return ONLY the SQL, no explanations.
-"""
-    ).substitute(
-        question=question,
-        schema=schema,
-        correction_plan=correction_plan,
-        old_sql=old_sql
-    )
\ No newline at end of file
+"""
\ No newline at end of file
@@ -3,9 +3,12 @@ SQL-of-Thought Evaluation Script (Final Version)
 Reproduce paper results using DeepSeek API
 """
 
-import json
+import asyncio
 import os
+import time
+import traceback
 from datetime import datetime
+from pathlib import Path
 from utils import *
 from prompts import *
 from analyze_by_subproblems import *
@@ -13,14 +16,289 @@ from analyze_by_subproblems import *
 # Configuration
 MAX_CRITIC_ATTEMPTS = 3  # Maximum correction attempts
 MODEL = "deepseek-chat"   # Model to use
+CONCURRENCY = 16          # Maximum number of samples processed concurrently
 
-def evaluate(num_samples=100, output_file=None):
+def _extract_subproblem_json(text):
+    """
+    Extract subproblem JSON from agent output
+    
+    Returns:
+        JSON string, or None if the output holds no valid JSON
+    """
+    # Output that is valid JSON as is (e.g. an array) is used unchanged
+    if load_subproblem_json(text) is not None:
+        return text.strip()
+    try:
+        sub_json = clean_json(text)
+    except ValueError:
+        return None
+    return sub_json if load_subproblem_json(sub_json) is not None else None
+
+
+async def _reformat_to_json(raw):
+    """
+    Ask the LLM to rewrite subproblem agent output as valid JSON
+    
+    Returns:
+        JSON string, or None if the reformatted output is not valid JSON either
+    """
+    reformatted = await call_agent(json_reformat_agent_prompt(raw), MODEL)
+    if not reformatted:
+        return None
+    return _extract_subproblem_json(reformatted)
+
+
+async def process_sample(idx, item, schemas, num_samples):
+    """
+    Run the agent pipeline on a single sample
+    
+    Args:
+        idx: Sample index
+        item: Spider sample
+        schemas: Mapping of database ID to schema string
+        num_samples: Number of evaluation samples
+    
+    Returns:
+        Result entry, or None if the sample was skipped
+    """
+    def log(msg=""):
+        # Samples run concurrently, so every line is tagged with its sample number
+        print(f"[Sample {idx + 1}] {msg}")
+
+    loop = asyncio.get_running_loop()
+
+    log(f"{'='*30} Sample {idx + 1}/{num_samples} {'='*30}")
+    
+    question = item['question']
+    gold_sql = item['query']
+    db_id = item['db_id']
+
+    log(f"Question: {question}")
+    log(f"Database: {db_id}")
+
+    # Load database schema
+    schema = schemas[db_id]
+    if not schema:
+        log(f"[ERROR] Failed to load schema, skipping this sample")
+        return None
+
+    entry = {
+        "sample_id": idx + 1,
+        "question": question,
+        "db_id": db_id,
+        "gold_sql": gold_sql,
+    }
+    gold_sql_processed = postprocess_sql(gold_sql)
+
+    try:
+        # ===== Agent 1: Schema Linking Agent =====
+        log("[1/5] Schema Linking Agent...")
+        schema_prompt = alt_schema_linking_agent_prompt(question, schema)
+        corrected_schema = await call_agent(schema_prompt, MODEL)
+        if not corrected_schema:
+            log("[ERROR] Schema Agent failed")
+            corrected_schema = schema
+        log(f"[Completed] Output length: {len(corrected_schema)} characters")
+
+        # ===== Agent 2: Subproblem Agent =====
+        log("[2/5] Subproblem Agent...")
+        subproblem_prompt = subproblem_agent_prompt(question, corrected_schema)
+        sub_json_raw = await call_agent(subproblem_prompt, MODEL)
+        if not sub_json_raw:
+            log("[ERROR] Subproblem Agent failed")
+            sub_json = "{}"
+        else:
+            sub_json = _extract_subproblem_json(sub_json_raw)
+            if sub_json is None:
+                log("[WARNING] Subproblem output is not valid JSON, requesting reformat")
+                sub_json = await _reformat_to_json(sub_json_raw)
+            if sub_json is None:
+                # Clauses are extracted from the raw output as text
+                sub_json = sub_json_raw
+        log(f"[Completed] Output: {sub_json[:100]}...")
+
+        # Parse SQL clauses from subproblems (already deduplicated, in stable order)
+        subproblem_specific_clauses = parse_subproblems(sub_json)
+        log(f"[Identified SQL clauses]: {subproblem_specific_clauses}")
+        subprob_plan, subprob_sql = clause_specific_prompts(subproblem_specific_clauses)
+
+        # ===== Agent 3: Query Plan Agent =====
+        log("[3/5] Query Plan Agent...")
+        plan_prompt = query_plan_agent_prompt(question, corrected_schema, sub_json)
+        plan = await call_agent(plan_prompt, MODEL)
+        if not plan:
+            log("[ERROR] Query Plan Agent failed")
+            plan = "Generate SQL based on the question"
+        log(f"[Completed] Plan: {plan[:150]}...")
+
+        # ===== Agent 4: SQL Generating Agent =====
+        log("[4/5] SQL Agent...")
+        sql_prompt = sql_agent_prompt(question, plan, corrected_schema)
+        sql = await call_agent(sql_prompt, MODEL)
+        if not sql:
+            log("[ERROR] SQL Agent failed")
+            entry["gen_sql"] = ""
+            entry["exact_match"] = False
+            entry["valid_sql"] = False
+            entry["exec_match"] = False
+            return entry
+    
+        sql = postprocess_sql(sql)
+        log(f"[Generated SQL]: {sql}")
+
+        # Execute SQL and check (in a worker thread, so a slow query does not block other samples)
+        exec_match, error = await loop.run_in_executor(
+            None, query_execution, db_id, gold_sql_processed, sql
+        )
+        exec_failed = not exec_match
+        attempts = 0
+
+        # ===== Agent 5: Correction Loop =====
+        if exec_failed:
+            log(f"[5/5] SQL correction loop (Error: {error})")
+    
+        while exec_failed and attempts < MAX_CRITIC_ATTEMPTS:
+            log(f"  Correction attempt {attempts + 1}/{MAX_CRITIC_ATTEMPTS}")
+        
+            # Generate correction plan
+            correction_plan_prompt = correction_plan_agent_prompt(
+                question, sql, corrected_schema, error
+            )
+            correction_plan = await call_agent(correction_plan_prompt, MODEL)
+            if correction_plan:
+                log(f"  [Correction plan]: {correction_plan[:100]}...")
+        
+            # Generate corrected SQL
+            correction_sql_prompt = correction_sql_agent_prompt(
+                question, corrected_schema, correction_plan, sql
+            )
+            corrected_sql = await call_agent(correction_sql_prompt, MODEL)
+            if not corrected_sql:
+                log("  [ERROR] Correction failed")
+                break
+        
+            sql = postprocess_sql(corrected_sql)
+            log(f"  [Corrected SQL]: {sql}")
+        
+            # Re-execute
+            exec_match, error = await loop.run_in_executor(
+                None, query_execution, db_id, gold_sql_processed, sql
+            )
+            exec_failed = not exec_match
+            attempts += 1
+        
+            if exec_match:
+                log(f"  ✓ Correction successful!")
+            elif attempts >= MAX_CRITIC_ATTEMPTS:
+                log(f"  ✗ Maximum attempts reached")
+
+        # ===== Calculate Metrics =====
+    
+        # Metric 1: Exact Match
+        entry["gen_sql"] = sql
+    
+        if sql.strip().lower() == gold_sql_processed.strip().lower():
+            entry["exact_match"] = True
+            log("✓ Exact Match")
+        else:
+            entry["exact_match"] = False
+            log("✗ Exact Match")
+
+        # Metric 2: Valid SQL (error of the last execution of sql)
+        entry["valid_sql"] = (error is None)
+        if error is None:
+            log("✓ Valid SQL")
+        else:
+            log(f"✗ Valid SQL: {error}")
+
+        # Metric 3: Execution Accuracy
+        entry["exec_match"] = exec_match
+        if exec_match:
+            log("✓ Execution Accuracy")
+        else:
+            log("✗ Execution Accuracy")
+
+    except Exception as e:
+        log(f"[ERROR] Error processing sample: {e}")
+        for line in traceback.format_exc().splitlines():
+            log(line)
+        
+        entry["gen_sql"] = ""
+        entry["error"] = str(e)
+        entry["exact_match"] = False
+        entry["valid_sql"] = False
+        entry["exec_match"] = False
+
+    return entry
+
+
+def count_metrics(results):
+    """
+    Count metrics over result entries
+    
+    Returns:
+        (total, exact match count, valid SQL count, execution accuracy count)
+    """
+    total = len(results)
+    exact_match = sum(1 for entry in results if entry["exact_match"])
+    valid_sql = sum(1 for entry in results if entry["valid_sql"])
+    exec_correct = sum(1 for entry in results if entry["exec_match"])
+    return total, exact_match, valid_sql, exec_correct
+
+
+async def run_samples(samples, schemas, num_samples, results_f, finished, concurrency=CONCURRENCY):
+    """
+    Process samples concurrently, at most `concurrency` at a time
+    
+    Each finished entry is appended to `finished` and written to `results_f`
+    as one JSON line right away, so an interrupted run keeps its results.
+    
+    Args:
+        samples: (index, Spider sample) pairs to process
+        schemas: Mapping of database ID to schema string
+        num_samples: Number of evaluation samples
+        results_f: Results file opened in binary mode
+        finished: List of finished entries (may hold entries of a resumed run)
+        concurrency: Number of samples processed concurrently
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded(idx, item):
+        async with sem:
+            entry = await process_sample(idx, item, schemas, num_samples)
+        if entry is None:
+            return
+        finished.append(entry)
+        results_f.write(dumps_json_line(entry))
+        results_f.flush()
+
+        # Print current statistics
+        total, exact_match, valid_sql, exec_correct = count_metrics(finished)
+        print(f"\n--- Progress ({total}/{num_samples}) ---")
+        print(f"Exact Match:        {exact_match}/{total} = {exact_match/total*100:.1f}%")
+        print(f"Valid SQL:          {valid_sql}/{total} = {valid_sql/total*100:.1f}%")
+        print(f"Execution Accuracy: {exec_correct}/{total} = {exec_correct/total*100:.1f}%")
+
+    try:
+        await asyncio.gather(*(bounded(idx, item) for idx, item in samples))
+    finally:
+        # The API client cannot be reused once this event loop ends
+        await close_client()
+
+
+def evaluate(num_samples=100, output_file=None, concurrency=CONCURRENCY, resume=None):
     """
     Evaluation function
     
+    Results are streamed to results/<name>.jsonl (one entry per line) while
+    the evaluation runs, and the summary is written to results/<name>_summary.json.
+    
     Args:
         num_samples: Number of evaluation samples (default: 100)
-        output_file: Output file name (default: auto-generated)
+        output_file: Output base name, any extension is dropped (default: auto-generated)
+        concurrency: Number of samples processed concurrently (default: 16)
+        resume: Results file (.jsonl) of an interrupted run to continue; entries are
+            appended to it and its summary is written next to it as <name>_summary.json
     """
     print("="*80)
     print("SQL-of-Thought Evaluation System")
@@ -28,6 +306,7 @@ def evaluate(num_samples=100, output_file=None):
     print(f"Model: {MODEL}")
     print(f"Number of samples: {num_samples}")
     print(f"Maximum correction attempts: {MAX_CRITIC_ATTEMPTS}")
+    print(f"Concurrency: {concurrency}")
     print("="*80)
     
     # Load data and taxonomy
@@ -41,197 +320,57 @@ def evaluate(num_samples=100, output_file=None):
     
     # Load error taxonomy
     try:
-        taxonomy = json.load(open("error_taxonomy.json"))
+        taxonomy = loads_json(Path("error_taxonomy.json").read_bytes())
     except FileNotFoundError:
         print("[WARNING] error_taxonomy.json not found, error classification will not be used")
         taxonomy = {}
     
-    # Initialize metrics
-    total, exact_match, valid_sql, exec_correct = 0, 0, 0, 0
-    results = []
+    # Results file, written while the evaluation runs
+    os.makedirs("results", exist_ok=True)
+    
+    if resume is not None:
+        # Continue the given results file in place
+        if not os.path.exists(resume):
+            print(f"[ERROR] Results file to resume not found: {resume}")
+            return
+        results_file = resume
+        summary_file = f"{os.path.splitext(resume)[0]}_summary.json"
+    else:
+        if output_file is None:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_base = f"results/eval_{num_samples}samples_{timestamp}"
+        else:
+            output_base = f"results/{Path(output_file).stem}"
+        results_file = f"{output_base}.jsonl"
+        summary_file = f"{output_base}_summary.json"
+    
+    # Reload entries of an interrupted run and skip those samples
+    results = load_results(results_file) if resume is not None else []
+    resumed = len(results)
+    done = {entry["sample_id"] for entry in results}
+    samples = [(idx, item) for idx, item in enumerate(dev) if idx + 1 not in done]
+    if done:
+        print(f"[INFO] Resuming {results_file}: {len(done)} samples already evaluated")
     
     # Record start time
-    start_time = datetime.now()
+    start_time = time.perf_counter()
     
-    # Iterate through samples
-    for idx, item in enumerate(dev):
-        print(f"\n{'='*80}")
-        print(f"Sample {idx + 1}/{num_samples}")
-        print(f"{'='*80}")
-        
-        question = item['question']
-        gold_sql = item['query']
-        db_id = item['db_id']
-
-        print(f"Question: {question}")
-        print(f"Database: {db_id}")
-
-        # Load database schema
-        schema = load_schema(db_id)
-        if not schema:
-            print(f"[ERROR] Failed to load schema, skipping this sample")
-            continue
-
-        entry = {
-            "sample_id": idx + 1,
-            "question": question,
-            "db_id": db_id,
-            "gold_sql": gold_sql,
-        }
-
-        try:
-            # ===== Agent 1: Schema Linking Agent =====
-            print("\n[1/5] Schema Linking Agent...")
-            schema_prompt = alt_schema_linking_agent_prompt(question, schema)
-            corrected_schema = call_agent(schema_prompt, MODEL)
-            if not corrected_schema:
-                print("[ERROR] Schema Agent failed")
-                corrected_schema = schema
-            print(f"[Completed] Output length: {len(corrected_schema)} characters")
-
-            # ===== Agent 2: Subproblem Agent =====
-            print("\n[2/5] Subproblem Agent...")
-            subproblem_prompt = subproblem_agent_prompt(question, corrected_schema)
-            sub_json_raw = call_agent(subproblem_prompt, MODEL)
-            if not sub_json_raw:
-                print("[ERROR] Subproblem Agent failed")
-                sub_json = "{}"
-            else:
-                sub_json = clean_json(sub_json_raw)
-            print(f"[Completed] Output: {sub_json[:100]}...")
-
-            # Parse SQL clauses from subproblems
-            subproblem_specific_clauses = list(set(parse_subproblems(sub_json)))
-            print(f"[Identified SQL clauses]: {subproblem_specific_clauses}")
-            subprob_plan, subprob_sql = clause_specific_prompts(subproblem_specific_clauses)
-
-            # ===== Agent 3: Query Plan Agent =====
-            print("\n[3/5] Query Plan Agent...")
-            plan_prompt = query_plan_agent_prompt(question, corrected_schema, sub_json)
-            plan = call_agent(plan_prompt, MODEL)
-            if not plan:
-                print("[ERROR] Query Plan Agent failed")
-                plan = "Generate SQL based on the question"
-            print(f"[Completed] Plan: {plan[:150]}...")
-
-            # ===== Agent 4: SQL Generating Agent =====
-            print("\n[4/5] SQL Agent...")
-            sql_prompt = sql_agent_prompt(question, plan, corrected_schema)
-            sql = call_agent(sql_prompt, MODEL)
-            if not sql:
-                print("[ERROR] SQL Agent failed")
-                entry["gen_sql"] = ""
-                entry["exact_match"] = False
-                entry["valid_sql"] = False
-                entry["exec_match"] = False
-                results.append(entry)
-                total += 1
-                continue
-            
-            sql = postprocess_sql(sql)
-            print(f"[Generated SQL]: {sql}")
-
-            # Execute SQL and check
-            exec_match, error = query_execution(item, sql)
-            exec_failed = not exec_match
-            attempts = 0
-
-            # ===== Agent 5: Correction Loop =====
-            if exec_failed:
-                print(f"\n[5/5] SQL correction loop (Error: {error})")
-            
-            while exec_failed and attempts < MAX_CRITIC_ATTEMPTS:
-                print(f"\n  Correction attempt {attempts + 1}/{MAX_CRITIC_ATTEMPTS}")
-                
-                # Generate correction plan
-                correction_plan_prompt = correction_plan_agent_prompt(
-                    question, sql, corrected_schema, error
-                )
-                correction_plan = call_agent(correction_plan_prompt, MODEL)
-                if correction_plan:
-                    print(f"  [Correction plan]: {correction_plan[:100]}...")
-                
-                # Generate corrected SQL
-                correction_sql_prompt = correction_sql_agent_prompt(
-                    question, corrected_schema, correction_plan, sql
-                )
-                corrected_sql = call_agent(correction_sql_prompt, MODEL)
-                if not corrected_sql:
-                    print("  [ERROR] Correction failed")
-                    break
-                
-                sql = postprocess_sql(corrected_sql)
-                print(f"  [Corrected SQL]: {sql}")
-                
-                # Re-execute
-                exec_match, error = query_execution(item, sql)
-                exec_failed = not exec_match
-                attempts += 1
-                
-                if exec_match:
-                    print(f"  ✓ Correction successful!")
-                elif attempts >= MAX_CRITIC_ATTEMPTS:
-                    print(f"  ✗ Maximum attempts reached")
-
-            # ===== Calculate Metrics =====
-            
-            # Metric 1: Exact Match
-            gold_sql_processed = postprocess_sql(gold_sql)
-            entry["gen_sql"] = sql
-            
-            if sql.strip().lower() == gold_sql_processed.strip().lower():
-                exact_match += 1
-                entry["exact_match"] = True
-                print("\n✓ Exact Match")
-            else:
-                entry["exact_match"] = False
-                print("\n✗ Exact Match")
-
-            # Metric 2: Valid SQL
-            gen_rows, gen_err = exec_query(
-                f"../spider/database/{db_id}/{db_id}.sqlite", sql
-            )
-            entry["valid_sql"] = (gen_err is None)
-            if gen_err is None:
-                valid_sql += 1
-                print("✓ Valid SQL")
-            else:
-                print(f"✗ Valid SQL: {gen_err}")
-
-            # Metric 3: Execution Accuracy
-            entry["exec_match"] = exec_match
-            if exec_match:
-                exec_correct += 1
-                print("✓ Execution Accuracy")
-            else:
-                print("✗ Execution Accuracy")
-
-            total += 1
-            results.append(entry)
-
-            # Print current statistics
-            print(f"\n--- Progress ({total}/{num_samples}) ---")
-            print(f"Exact Match:        {exact_match}/{total} = {exact_match/total*100:.1f}%")
-            print(f"Valid SQL:          {valid_sql}/{total} = {valid_sql/total*100:.1f}%")
-            print(f"Execution Accuracy: {exec_correct}/{total} = {exec_correct/total*100:.1f}%")
-        
-        except Exception as e:
-            print(f"\n[ERROR] Error processing sample: {e}")
-            import traceback
-            traceback.print_exc()
-            
-            entry["gen_sql"] = ""
-            entry["error"] = str(e)
-            entry["exact_match"] = False
-            entry["valid_sql"] = False
-            entry["exec_match"] = False
-            results.append(entry)
-            total += 1
-            continue
+    # Load the schemas of all databases used by the samples
+    schemas = preload_all_schemas(sorted({item['db_id'] for _, item in samples}))
+    
+    try:
+        with open(results_file, "ab" if resume is not None else "wb") as results_f:
+            asyncio.run(run_samples(samples, schemas, num_samples, results_f, results, concurrency))
+    finally:
+        close_connections()
+    
+    results.sort(key=lambda entry: entry["sample_id"])
+    total, exact_match, valid_sql, exec_correct = count_metrics(results)
     
-    # Calculate total time
+    # Calculate time of this session (entries reloaded by resume are not timed)
+    duration = time.perf_counter() - start_time
     end_time = datetime.now()
-    duration = (end_time - start_time).total_seconds()
+    session_total = total - resumed
     
     # ===== Generate Final Report =====
     summary = {
@@ -243,39 +382,30 @@ def evaluate(num_samples=100, output_file=None):
         "exact_match_rate": round(exact_match / total, 4) if total > 0 else 0,
         "valid_sql_rate": round(valid_sql / total, 4) if total > 0 else 0,
         "execution_accuracy_rate": round(exec_correct / total, 4) if total > 0 else 0,
+        "resumed_samples": resumed,
+        "session_samples": session_total,
         "duration_seconds": duration,
-        "avg_time_per_sample": round(duration / total, 2) if total > 0 else 0,
-        "timestamp": datetime.now().isoformat()
+        "avg_time_per_sample": round(duration / session_total, 2) if session_total > 0 else 0,
+        "timestamp": end_time.isoformat(),
+        "results_file": results_file
     }
 
-    output = {
-        "summary": summary,
-        "results": results
-    }
-
-    # Save results
-    os.makedirs("results", exist_ok=True)
-    
-    if output_file is None:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_file = f"results/eval_{num_samples}samples_{timestamp}.json"
-    else:
-        output_file = f"results/{output_file}"
-    
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    with open(summary_file, "w", encoding="utf-8") as f:
+        f.write(dumps_json(summary))
 
     # Print final report
     print("\n" + "="*80)
     print("Evaluation completed!")
     print("="*80)
-    print(f"\nTotal time: {duration:.1f} seconds ({duration/60:.1f} minutes)")
-    print(f"Average time per sample: {duration/total:.1f} seconds")
+    print(f"\nTime of this session: {duration:.1f} seconds ({duration/60:.1f} minutes)")
+    if session_total > 0:
+        print(f"Average time per sample: {duration/session_total:.1f} seconds")
     print("\nFinal results:")
     print(f"  Exact Match:        {exact_match}/{total} = {exact_match/total*100:.2f}%")
     print(f"  Valid SQL:          {valid_sql}/{total} = {valid_sql/total*100:.2f}%")
     print(f"  Execution Accuracy: {exec_correct}/{total} = {exec_correct/total*100:.2f}%")
-    print(f"\nResults saved to: {output_file}")
+    print(f"\nResults saved to: {results_file}")
+    print(f"Summary saved to: {summary_file}")
     
     # Compare with original paper (if available)
     print("\n" + "="*80)
@@ -301,11 +431,16 @@ if __name__ == '__main__':
     parser.add_argument('--samples', type=int, default=100,
                        help='Number of evaluation samples (default: 100)')
     parser.add_argument('--output', type=str, default=None,
-                       help='Output file name (default: auto-generated)')
+                       help='Output base name for results/<name>.jsonl and results/<name>_summary.json (default: auto-generated)')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                       help=f'Number of samples processed concurrently (default: {CONCURRENCY})')
+    parser.add_argument('--resume', type=str, default=None,
+                       help='Results file (.jsonl) of an interrupted run to continue')
     
     args = parser.parse_args()
     
     print(f"\nStarting evaluation...")
     print(f"Number of samples: {args.samples}")
     
-    evaluate(num_samples=args.samples, output_file=args.output)
\ No newline at end of file
+    evaluate(num_samples=args.samples, output_file=args.output, concurrency=args.concurrency,
+             resume=args.resume)
\ No newline at end of file
@@ -1,10 +1,20 @@
+import functools
+import importlib.util
 import json, os, re
-from openai import OpenAI
-from typing import List, Dict, Optional
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
 import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ==================== API Configuration ====================
 # Read DeepSeek API key from environment variable (removed for security)
 DEEPSEEK_API_KEY = ""
@@ -16,37 +26,113 @@ if not DEEPSEEK_API_KEY:
     print("  export DEEPSEEK_API_KEY='your_key_here'")
     print("="*80)
 
-# Configure OpenAI client to use DeepSeek API
-openai_client = OpenAI(
-    api_key=DEEPSEEK_API_KEY,
-    base_url="https://api.deepseek.com/v1"
-)
 
-print(f"[INFO] DeepSeek API configured")
+@functools.lru_cache(maxsize=None)
+def _get_client():
+    """
+    Get the OpenAI client configured for DeepSeek API, created on first use
+    """
+    import httpx
+    from openai import AsyncOpenAI
+
+    # One keep-alive connection pool shared by all API calls (HTTP/2 if h2 is installed)
+    http_client = httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+        timeout=60.0
+    )
+    openai_client = AsyncOpenAI(
+        api_key=DEEPSEEK_API_KEY,
+        base_url="https://api.deepseek.com/v1",
+        http_client=http_client
+    )
+    print(f"[INFO] DeepSeek API configured")
+    return openai_client
+
+
+async def close_client():
+    """
+    Close the API client if it was created; the next API call creates a new one
+    
+    The client's connection pool is bound to the event loop it is used on,
+    so it must be closed before that loop ends (e.g. at the end of asyncio.run).
+    """
+    if _get_client.cache_info().currsize:
+        client = _get_client()
+        _get_client.cache_clear()
+        await client.close()
 # ==================== End of API Configuration ====================
 
+SPIDER_DB_DIR = "../spider/database"
+SCHEMA_LOAD_WORKERS = 16  # Threads used to preload database schemas
+FETCH_BATCH_SIZE = 1024  # Rows fetched per fetchmany call when streaming results
+
+
+# orjson is much faster than stdlib json; fall back to json if not installed
+loads_json = orjson.loads if orjson else json.loads
+
+
+def dumps_json(obj) -> str:
+    """Serialize object to indented JSON text"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
+
+def dumps_json_line(obj) -> bytes:
+    """Serialize object to a single JSON line"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+# Patterns used by postprocess_sql, compiled once at import
+_SQL_START = re.compile(r'\b(select|insert)\b', re.IGNORECASE)
+_FENCE = re.compile(r"```sql|```")
+_SQL_PREFIX = re.compile(r"^sql[:\s]*")
+_WS = re.compile(r"\s+")
+_WS_COMMA = re.compile(r"\s+,")
+
 
 def normalize_rows(rows):
-    """Normalize query results for comparison"""
-    return sorted([tuple(sorted(map(str, r))) for r in rows])
+    """Normalize query results for comparison (row order and column order ignored)"""
+    return Counter(tuple(sorted(map(str, r))) for r in rows)
+
+
+def _exec_gen(db_id: str, sql: str):
+    """
+    Execute SQL and normalize its rows
+    
+    Returns:
+        (Normalized rows as a hashable frozenset of (row, count) pairs, error message)
+    """
+    norm, err = exec_query(f"{SPIDER_DB_DIR}/{db_id}/{db_id}.sqlite", sql, consumer=normalize_rows)
+    if err is not None:
+        return None, err
+    return frozenset(norm.items()), None
 
 
-def query_execution(item, sql):
+@functools.lru_cache(maxsize=2048)
+def _exec_gold(db_id: str, gold_sql: str):
+    """
+    Execute gold SQL and normalize its rows (cached, the result of a gold query never changes)
+    """
+    return _exec_gen(db_id, gold_sql)
+
+
+def query_execution(db_id, gold_sql, sql):
     """
     Execute SQL query and compare results with gold SQL
+    gold_sql must already be postprocessed
     Returns: (whether matched, error message)
     """
     sql = postprocess_sql(sql)
-    gold_sql = postprocess_sql(item['query'])
-    db_id = item['db_id']
 
     # Execute gold SQL and generated SQL
-    gold_rows, gold_err = exec_query(f"../spider/database/{db_id}/{db_id}.sqlite", gold_sql)
-    gen_rows, gen_err = exec_query(f"../spider/database/{db_id}/{db_id}.sqlite", sql)
+    gold_norm, gold_err = _exec_gold(db_id, gold_sql)
+    gen_norm, gen_err = _exec_gen(db_id, sql)
     
     if gen_err is None and gold_err is None:
-        gen_norm = normalize_rows(gen_rows)
-        gold_norm = normalize_rows(gold_rows)
         exec_match = (gen_norm == gold_norm)
     else:
         exec_match = False
@@ -54,7 +140,7 @@ def query_execution(item, sql):
     return exec_match, gen_err
 
 
-def call_agent(prompt: str, model="deepseek-chat", temperature: float = 0.0) -> str:
+async def call_agent(prompt: str, model="deepseek-chat", temperature: float = 0.0) -> str:
     """
     Call DeepSeek API
     
@@ -67,7 +153,7 @@ def call_agent(prompt: str, model="deepseek-chat", temperature: float = 0.0) ->
         Model response text
     """
     try:
-        resp = openai_client.chat.completions.create(
+        resp = await _get_client().chat.completions.create(
             model=model,
             messages=[{"role": "user", "content": prompt}],
             temperature=temperature,
@@ -81,17 +167,15 @@ def call_agent(prompt: str, model="deepseek-chat", temperature: float = 0.0) ->
 
 def postprocess_sql(sql: str) -> str:
     """Postprocess SQL to remove redundant formatting"""
-    sql_start_pattern = r'\b(select|insert)\b'
-    match = re.search(sql_start_pattern, sql, re.IGNORECASE)
+    match = _SQL_START.search(sql)
     if match:
         sql = sql[match.start():]
     sql = sql.strip().lower()
-    sql = re.sub(r"```sql|```", "", sql)
-    sql = re.sub(r"^sql[:\s]*", "", sql)
-    sql = re.sub(r"```sql|```", "", sql)
+    sql = _FENCE.sub("", sql)
+    sql = _SQL_PREFIX.sub("", sql)
     sql = sql.replace("`", "")
-    sql = re.sub(r"\s+", " ", sql).strip()
-    sql = re.sub(r"\s+,", ",", sql)
+    sql = _WS.sub(" ", sql).strip()
+    sql = _WS_COMMA.sub(",", sql)
     if sql.endswith(";"):
         sql = sql[:-1].strip()
     return sql
@@ -118,98 +202,212 @@ def load_spider(dev: bool = True, testing=False) -> List[Dict]:
         print("Please ensure Spider dataset is in the correct location")
         return []
     
-    with open(path) as f:
-        data = json.load(f)
+    data = loads_json(Path(path).read_bytes())
     
     print(f"[INFO] Successfully loaded {path}, total {len(data)} samples")
     return data
 
 
-def exec_query(db_file: str, sql: str):
+def load_results(path: str) -> List[Dict]:
+    """
+    Load result entries from a JSONL results file
+    
+    A last line cut off by an interrupted run is truncated from the file,
+    so its sample is evaluated again and appended entries start on a new line.
+    
+    Args:
+        path: Results file path
+    
+    Returns:
+        List of result entries
+    """
+    if not os.path.exists(path):
+        print(f"[WARNING] Results file not found: {path}")
+        return []
+    
+    with open(path, "rb+") as f:
+        data = f.read()
+        # Everything up to the last newline was written completely
+        end = data.rfind(b"\n") + 1
+        tail = data[end:]
+        if tail.strip():
+            try:
+                loads_json(tail)
+            except ValueError:
+                print(f"[WARNING] Dropping incomplete last line of {path}")
+                f.truncate(end)
+            else:
+                # Complete entry that only misses its newline
+                f.write(b"\n")
+                end = len(data)
+    
+    return [loads_json(line) for line in data[:end].splitlines() if line.strip()]
+
+
+def _iter_rows(cur: sqlite3.Cursor):
+    """Yield result rows of a cursor, fetched in batches of cur.arraysize"""
+    while (batch := cur.fetchmany()):
+        yield from batch
+
+
+def exec_query(db_file: str, sql: str, consumer=None):
     """
     Execute SQL query
     
     Args:
         db_file: Database file path
         sql: SQL query statement
+        consumer: Callable taking an iterable of result rows; rows are streamed
+            into it instead of being collected into a list (default: None)
     
     Returns:
-        (Query results, error message)
+        (Query results, or return value of consumer, error message)
     """
     if not os.path.exists(db_file):
         return None, f"Database file does not exist: {db_file}"
     
-    conn = sqlite3.connect(db_file)
+    conn = get_connection(db_file)
     try:
-        cur = conn.cursor()
-        cur.execute(sql)
-        rows = cur.fetchall()
-        return rows, None
+        cur = conn.execute(sql)
+        if consumer is None:
+            return cur.fetchall(), None
+        cur.arraysize = FETCH_BATCH_SIZE
+        return consumer(_iter_rows(cur)), None
     except Exception as e:
         return None, str(e)
     finally:
-        conn.close()
+        # Discard any changes made by the query, as closing the connection used to
+        conn.rollback()
+
+
+# Open SQLite connections, keyed by (thread ID, database file path)
+# Queries run in worker threads, so each thread gets connections of its own
+_CONNECTIONS: Dict[Tuple[int, str], sqlite3.Connection] = {}
+_CONNECTIONS_LOCK = threading.Lock()
+
+
+def get_connection(db_file: str) -> sqlite3.Connection:
+    """
+    Get the calling thread's cached connection to the database, opening it on first use
+    """
+    key = (threading.get_ident(), db_file)
+    with _CONNECTIONS_LOCK:
+        conn = _CONNECTIONS.get(key)
+        if conn is None:
+            # check_same_thread=False only so that close_connections can close it
+            conn = sqlite3.connect(db_file, check_same_thread=False)
+            _CONNECTIONS[key] = conn
+    return conn
+
+
+def close_connections():
+    """
+    Close all cached database connections
+    """
+    with _CONNECTIONS_LOCK:
+        for conn in _CONNECTIONS.values():
+            conn.close()
+        _CONNECTIONS.clear()
 
 
 def load_schema(db_id: str) -> str:
     """
     Load database schema
     
+    Column and foreign key information of all tables is fetched with one
+    query each through the pragma_table_info / pragma_foreign_key_list
+    table-valued functions, instead of two PRAGMA statements per table.
+    
     Args:
         db_id: Database ID
     
     Returns:
         Schema string
     """
-    db_path = f"../spider/database/{db_id}/{db_id}.sqlite"
+    db_path = f"{SPIDER_DB_DIR}/{db_id}/{db_id}.sqlite"
     
     if not os.path.exists(db_path):
         print(f"[ERROR] Database not found: {db_path}")
         return ""
 
     conn = sqlite3.connect(db_path)
-    conn.execute("PRAGMA foreign_keys=ON;")
-    cur = conn.cursor()
-    
-    # Get all table names
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
-    tables = [row[0] for row in cur.fetchall()]
+    try:
+        # Get all table names
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
+        )]
+
+        # Get column information and primary keys of all tables
+        cols = {tbl: [] for tbl in tables}
+        pks = {tbl: [] for tbl in tables}
+        for tbl, col, pk in conn.execute(
+            "SELECT m.name, p.name, p.pk FROM sqlite_master m, pragma_table_info(m.name) p "
+            "WHERE m.type='table' AND m.name NOT LIKE 'sqlite_%';"
+        ):
+            cols[tbl].append(col)
+            if pk > 0:
+                pks[tbl].append(col)
+
+        # Get foreign keys of all tables
+        fks = {tbl: [] for tbl in tables}
+        for tbl, ref_tbl, from_col, to_col in conn.execute(
+            'SELECT m.name, f."table", f."from", f."to" FROM sqlite_master m, pragma_foreign_key_list(m.name) f '
+            "WHERE m.type='table' AND m.name NOT LIKE 'sqlite_%';"
+        ):
+            fks[tbl].append((ref_tbl, from_col, to_col))
+    finally:
+        conn.close()
 
     schema_lines = []
     for tbl in tables:
         schema_lines.append(f"{tbl}:")
-        
-        # Get column information and primary keys
-        cur.execute(f"PRAGMA table_info({tbl});")
-        cols = cur.fetchall()
-        col_names = [c[1] for c in cols]
-        pks = [c[1] for c in cols if c[5] > 0]
-        
-        schema_lines.append(f"  Columns: {', '.join(col_names)}")
-        if pks:
-            schema_lines.append(f"  Primary Key: {', '.join(pks)}")
-        
-        # Get foreign keys
-        cur.execute(f"PRAGMA foreign_key_list({tbl});")
-        fks = cur.fetchall()
-        if fks:
+        schema_lines.append(f"  Columns: {', '.join(cols[tbl])}")
+        if pks[tbl]:
+            schema_lines.append(f"  Primary Key: {', '.join(pks[tbl])}")
+        if fks[tbl]:
             schema_lines.append(f"  Foreign Keys:")
-            for fk in fks:
-                _, _, ref_tbl, from_col, to_col, *_ = fk
+            for ref_tbl, from_col, to_col in fks[tbl]:
                 schema_lines.append(f"    - {from_col} → {ref_tbl}.{to_col}")
 
-    conn.close()
     return "\n".join(schema_lines)
 
 
+def preload_all_schemas(db_ids=None) -> Dict[str, str]:
+    """
+    Load database schemas up front, one connection per database, in parallel threads
+    
+    Args:
+        db_ids: Database IDs to load (default: all databases in the Spider directory)
+    
+    Returns:
+        Mapping of database ID to schema string
+    """
+    if db_ids is None:
+        db_ids = sorted(
+            d for d in os.listdir(SPIDER_DB_DIR) if os.path.isdir(os.path.join(SPIDER_DB_DIR, d))
+        )
+    db_ids = list(db_ids)
+
+    # Loading is I/O bound; each worker opens its own connection
+    with ThreadPoolExecutor(max_workers=SCHEMA_LOAD_WORKERS) as executor:
+        schemas = dict(zip(db_ids, executor.map(load_schema, db_ids)))
+    print(f"[INFO] Loaded {len(schemas)} database schemas")
+    return schemas
+
+
 def clean_json(text: str) -> str:
     """
     Extract JSON object from text
     """
+    # Fast path: text is already a bare JSON object
+    stripped = text.strip()
+    if stripped.startswith('{') and stripped.endswith('}'):
+        return stripped
     start = text.find('{')
     if start == -1:
         raise ValueError("No JSON object found")
-    end = text.rfind('}')
+    # Only search for the closing brace after the opening one
+    end = text.rfind('}', start)
     if end == -1:
         raise ValueError("No closing '}' found")
     json_str = text[start:end+1]
@@ -221,27 +419,17 @@ def clean_json_prefix(text: str) -> str:
     """
     Remove all characters before JSON
     """
-    match = re.search(r'\{', text)
-    if not match:
+    start = text.find('{')
+    if start == -1:
         raise ValueError("No JSON object found in critic response")
-    trimmed = text[match.start():]
-    trimmed = re.sub(r'^```+', '', trimmed)
-    trimmed = re.sub(r"^['\"]+", '', trimmed)
-    end = text.rfind('}')
-    json_str = trimmed[:end+1]
+    end = text.rfind('}', start)
+    json_str = text[start:end+1]
     json_str = json_str.strip("`\n\r ")
     return json_str
 
 
-def clause_specific_prompts(clauses):
-    """
-    Generate prompts for specific SQL clauses
-    """
-    plan, sql = "", ""
-    for clause in clauses:
-        clause = clause.upper()
-        if clause in ["HAVING", "GROUPBY", "GROUP BY"]:
-            plan += """
+# Prompt blocks for specific SQL clauses
+_PLAN_GROUPBY = """
     GROUP BY detected:
     - All non-aggregated SELECT columns must be in GROUP BY.
     - GROUP BY should appear after WHERE but before HAVING/ORDER BY.
@@ -249,7 +437,7 @@ def clause_specific_prompts(clauses):
     If HAVING is present:
     - Use HAVING to filter on aggregates, not WHERE.
     """
-            sql += """
+_SQL_GROUPBY = """
     Ensure:
     - All non-aggregated SELECT columns are in GROUP BY.
     - HAVING filters only aggregated expressions.
@@ -257,86 +445,117 @@ def clause_specific_prompts(clauses):
     - Use WHERE for pre-aggregation filters only.
     """
 
-        if clause in ["ORDERBY", "ORDER BY"]:
-            plan += """
+_PLAN_ORDERBY = """
     ORDER BY detected:
     - Specify column(s) to sort on with direction (ASC/DESC).
     - ORDER BY should be planned after WHERE/ GROUP BY / HAVING steps.
     - If LIMIT or OFFSET is present, ORDER BY must come before them.
     """
-            sql += """
+_SQL_ORDERBY = """
     Ensure:
     - ORDER BY references valid columns (or aliases defined in SELECT/grouping).
     - ORDER BY is placed after GROUP BY or HAVING if those exist.
     - If LIMIT is used, ORDER BY must guarantee deterministic results.
     """
 
-        if clause == "LIMIT":
-            plan += """
+_PLAN_LIMIT = """
     LIMIT detected:
     - Decide which rows are returned: use ORDER BY to define which subset is used.
     - Plan ORDER BY step before LIMIT to ensure consistent results.
     """
-            sql += """
+_SQL_LIMIT = """
     Ensure:
     - Use ORDER BY before LIMIT for deterministic row selection.
     - LIMIT appears as the final clause after ORDER BY.
     """
 
-        if clause == "JOIN":
-            plan += """
+_PLAN_JOIN = """
     JOIN detected:
     - Plan all necessary JOINs between tables, listing each table and ON condition.
     - Each JOIN must reference valid foreign key paths from schema.
     - Avoid Cartesian products: every JOIN must include a precise ON clause.
     """
-            sql += """
+_SQL_JOIN = """
     Ensure:
     - Include all tables referenced in the plan via JOINS.
     - Each JOIN uses correct foreign key column(s) in ON clause.
     - Do not introduce unintended full joins or missing JOIN conditions.
     """
 
-        if clause == "UNION":
-            plan += """
+_PLAN_UNION = """
     UNION detected:
     - Both subqueries must select the same number of columns with compatible types.
     - Specify UNION vs UNION ALL depending on whether duplicates should be removed.
     - Plan ORDER BY / LIMIT after the entire UNION block.
     """
-            sql += """
+_SQL_UNION = """
     Ensure:
     - Each UNION branch has identical column count and data types.
     - Use DISTINCT (default UNION) or ALL explicitly.
     - If ORDER BY or LIMIT is applied, apply it only at the end of the UNION output.
     """
 
-        if clause == "INTERSECT":
-            plan += """
+_PLAN_INTERSECT = """
     INTERSECT detected:
     - Both queries must select the same number and type of columns.
     - Plan for duplicates: INTERSECT removes duplicates unless INTERSECT ALL is specified.
     - ORDER BY / LIMIT clauses apply after the intersect.
     """
-            sql += """
+_SQL_INTERSECT = """
     Ensure:
     - Each INTERSECT branch selects same number and types of columns.
     - Use INTERSECT or INTERSECT ALL as needed.
     - Place ORDER BY and LIMIT after the intersect expression.
     """
 
-        if clause == "EXCEPT":
-            plan += """
+_PLAN_EXCEPT = """
     EXCEPT detected:
     - Both queries must select the same number and type of columns.
     - Plan which side to apply EXCEPT (left - right rows).
     - ORDER BY / LIMIT should be planned after the EXCEPT block.
     """
-            sql += """
+_SQL_EXCEPT = """
     Ensure:
     - EXCEPT branches share identical column count/types.
     - Use EXCEPT or EXCEPT ALL appropriately.
     - Apply ORDER BY and LIMIT only to the final output of the EXCEPT.
     """
 
-    return plan, sql
\ No newline at end of file
+# (plan, sql) prompt blocks per normalized clause, in the order they are emitted
+_CLAUSE_PROMPTS = {
+    "HAVING": (_PLAN_GROUPBY, _SQL_GROUPBY),
+    "GROUPBY": (_PLAN_GROUPBY, _SQL_GROUPBY),
+    "ORDERBY": (_PLAN_ORDERBY, _SQL_ORDERBY),
+    "LIMIT": (_PLAN_LIMIT, _SQL_LIMIT),
+    "JOIN": (_PLAN_JOIN, _SQL_JOIN),
+    "UNION": (_PLAN_UNION, _SQL_UNION),
+    "INTERSECT": (_PLAN_INTERSECT, _SQL_INTERSECT),
+    "EXCEPT": (_PLAN_EXCEPT, _SQL_EXCEPT),
+}
+
+
+def clause_specific_prompts(clauses):
+    """
+    Generate prompts for specific SQL clauses
+    Each prompt block is included once, however often its clause is repeated
+    """
+    # Normalize so that e.g. "group by" and "GROUPBY" share a cache entry
+    return _clause_specific_prompts(frozenset(c.upper().replace(" ", "") for c in clauses))
+
+
+@functools.lru_cache(maxsize=256)
+def _clause_specific_prompts(clauses: frozenset):
+    """
+    Build prompts for a set of normalized SQL clauses (cached)
+    """
+    plan_parts, sql_parts = [], []
+    emitted = set()
+    for clause, blocks in _CLAUSE_PROMPTS.items():
+        # Clauses sharing prompt blocks (HAVING and GROUPBY) emit them only once
+        if clause in clauses and blocks not in emitted:
+            emitted.add(blocks)
+            plan, sql = blocks
+            plan_parts.append(plan)
+            sql_parts.append(sql)
+
+    return "".join(plan_parts), "".join(sql_parts)
\ No newline at end of file